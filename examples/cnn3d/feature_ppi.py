@@ -44,16 +44,22 @@ grid_config = util.dotdict({
 })
 
 
-def df_to_feature(struct0, struct1, center0, center1, grid_config,
-                  random_seed=None):
-    def __feature(struct, center):
+def df_to_atoms(struct0, struct1, center0, center1, grid_config):
+    coords0, channels0 = subgrid_gen.get_atoms(struct0, center0, grid_config)
+    coords1, channels1 = subgrid_gen.get_atoms(struct1, center1, grid_config)
+    return coords0, channels0, coords1, channels1
+
+
+def atoms_to_feature(coords0, channels0, coords1, channels1, grid_config,
+                     random_seed=None, dtype=np.float32):
+    def __feature(coords, channels):
         rot_mat = subgrid_gen.gen_rot_matrix(grid_config, random_seed=random_seed)
-        grid = subgrid_gen.get_grid(
-            struct, center, config=grid_config, rot_mat=rot_mat)
+        grid = subgrid_gen.get_grid_from_atoms(
+            coords, channels, config=grid_config, rot_mat=rot_mat, dtype=dtype)
         return grid
 
-    grid0 = __feature(struct0, center0)
-    grid1 = __feature(struct1, center1)
+    grid0 = __feature(coords0, channels0)
+    grid1 = __feature(coords1, channels1)
     feature = np.array([grid0, grid1])
     return feature
 
@@ -95,15 +101,40 @@ def __get_res_pair_ca_coords(samples_df, structs_df):
     return cas
 
 
+def get_shard_nums(sharded, use_shard_nums=None):
+    """ Get the shard numbers to generate the dataset from. """
+    if use_shard_nums is None:
+        return np.arange(sharded.get_num_shards())
+    return np.array(use_shard_nums)
+
+
 def dataset_generator(sharded, grid_config, shuffle=True, repeat=None,
                       max_num_ensembles=None, testing=False,
                       use_shard_nums=None, random_seed=None):
-
-    if use_shard_nums is None:
-        num_shards = sharded.get_num_shards()
-        all_shard_nums = np.arange(num_shards)
-    else:
-        all_shard_nums = use_shard_nums
+    """
+    Generate (name, feature, label) examples, where feature is the pair of
+    subgrids around the two residues.
+    """
+    gen = atoms_generator(
+        sharded, grid_config, shuffle=shuffle, repeat=repeat,
+        max_num_ensembles=max_num_ensembles, testing=testing,
+        use_shard_nums=use_shard_nums)
+    for name, coords0, channels0, coords1, channels1, label in gen:
+        feature = atoms_to_feature(coords0, channels0, coords1, channels1,
+                                   grid_config, random_seed)
+        yield name, feature, label
+
+
+def atoms_generator(sharded, grid_config, shuffle=True, repeat=None,
+                    max_num_ensembles=None, testing=False,
+                    use_shard_nums=None):
+    """
+    Generate (name, coords0, channels0, coords1, channels1, label) examples,
+    the atoms that make up the subgrids of the two residues.  Rendering the
+    subgrids from them is left to the caller, see atoms_to_feature.
+    """
+
+    all_shard_nums = get_shard_nums(sharded, use_shard_nums)
 
     seen = col.defaultdict(set)
     ensemble_count = 0
@@ -176,15 +207,15 @@ def dataset_generator(sharded, grid_config, shuffle=True, repeat=None,
 
                 pos_features = []
                 for (res0, res1, center0, center1) in pos_pairs_cas:
-                    fgrid = df_to_feature(structs_df[0], structs_df[1], center0,
-                                          center1, grid_config, random_seed)
-                    pos_features.append(('{:}/{:}/{:}'.format(ensemble_name, res0, res1), fgrid, np.array([1])))
+                    atoms = df_to_atoms(structs_df[0], structs_df[1], center0,
+                                        center1, grid_config)
+                    pos_features.append(('{:}/{:}/{:}'.format(ensemble_name, res0, res1), *atoms, np.array([1])))
 
                 neg_features = []
                 for (res0, res1, center0, center1) in neg_pairs_cas:
-                    fgrid = df_to_feature(structs_df[0], structs_df[1], center0,
-                                          center1, grid_config, random_seed)
-                    neg_features.append(('{:}/{:}/{:}'.format(ensemble_name, res0, res1), fgrid, np.array([0])))
+                    atoms = df_to_atoms(structs_df[0], structs_df[1], center0,
+                                        center1, grid_config)
+                    neg_features.append(('{:}/{:}/{:}'.format(ensemble_name, res0, res1), *atoms, np.array([0])))
 
                 for f in util.intersperse(pos_features, neg_features):
                     yield f
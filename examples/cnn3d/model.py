@@ -122,26 +122,21 @@ def siamese_model(x, training, conv_drop_rate, fc_drop_rate, top_nn_drop_rate,
                  dropout=False,
                  top_nn_activation=None):
 
-    grid_left = x[:, 0]
-    grid_right = x[:, 1]
+    # Run the left and right grids through the shared base network as a
+    # single batch of twice the size, i.e. [B, 2, ...] -> [2B, ...].
+    grids = tf.reshape(x, [-1] + x.shape.as_list()[2:])
 
     with tf.variable_scope('base_networks', reuse=tf.AUTO_REUSE):
-        processed_left = base_network(
-            grid_left, training, conv_drop_rate, fc_drop_rate,
+        processed = base_network(
+            grids, training, conv_drop_rate, fc_drop_rate,
             conv_filters, conv_kernel_size,
             max_pool_positions, max_pool_sizes, max_pool_strides,
             fc_units,
             batch_norm, dropout)
 
-    with tf.variable_scope('base_networks', reuse=tf.AUTO_REUSE):
-        processed_right = base_network(
-            grid_right, training, conv_drop_rate, fc_drop_rate,
-            conv_filters, conv_kernel_size,
-            max_pool_positions, max_pool_sizes, max_pool_strides,
-            fc_units,
-            batch_norm, dropout)
-
-    x = tf.concat([processed_left, processed_right], 1, name='concat')
+    # Back to [B, 2 * F], left features followed by right ones.
+    x = tf.reshape(processed, [-1, 2 * processed.shape.as_list()[-1]],
+                   name='concat')
 
     # Deep non-siamese.
     with tf.variable_scope("top_nn"):
@@ -173,10 +168,17 @@ def siamese_model(x, training, conv_drop_rate, fc_drop_rate, top_nn_drop_rate,
     return logits
 
 
-def training(loss, learning_rate):
+def training(loss, learning_rate, mixed_precision=False):
     optimizer = tf.train.AdamOptimizer(learning_rate, beta1=0.9)
     #optimizer = tf.train.RMSPropOptimizer(learning_rate, decay = 0.999)
 
+    if mixed_precision:
+        # Dynamic loss scaling keeps small float16 gradients from underflowing.
+        # The float16 rewrite itself has to be turned on in the config of the
+        # session running the graph (auto_mixed_precision).
+        optimizer = tf.train.experimental.MixedPrecisionLossScaleOptimizer(
+            optimizer, loss_scale='dynamic')
+
     # Update moving_mean and moving_variance of batch norm
     update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
     
@@ -39,32 +39,68 @@ def get_grid(df, center, config, rot_mat=np.eye(3, 3)):
         4-d numpy array representing an occupancy grid where last dimension
         is atom channel.  First 3 dimension are of size radius_ang * 2 + 1.
     """
+    at, channels = get_atoms(df, center, config)
+    return get_grid_from_atoms(at, channels, config, rot_mat=rot_mat)
+
+
+def get_atoms(df, center, config):
+    """
+    Select the atoms of a region that can end up in its grid.
+    Args:
+        df (pd.DataFrame):
+            region to select atoms from.
+        center (3x3 np.array):
+            center of the grid.
+    Returns:
+        Tuple of the atom coordinates relative to center, as an Nx3 array, and
+        the channel of each atom, as an N array.  Atoms with unrecognized
+        elements or out of reach of the grid under any rotation are dropped.
+    """
     size = grid_size(config)
     true_radius = size * config.resolution / 2.0
-
-    # Select valid atoms.
-    at = df[['x', 'y', 'z']].values.astype(np.float32)
-    elements = df['element'].values
+    max_dist = np.sqrt(3) * true_radius + config.resolution
 
     # Center atoms.
+    at = df[['x', 'y', 'z']].values.astype(np.float32)
     at = at - center
 
+    # Map elements to channels, unrecognized elements map to NaN.
+    channels = df['element'].map(config.element_mapping).values
+
+    sel = ~np.isnan(channels) & (np.sum(at ** 2, axis=1) <= max_dist ** 2)
+    return at[sel], channels[sel].astype(np.int8)
+
+
+def get_grid_from_atoms(at, channels, config, rot_mat=np.eye(3, 3),
+                        dtype=np.float32):
+    """
+    Generate the 3d grid from centered atoms.
+    Args:
+        at (Nx3 np.array):
+            atom coordinates, relative to the center of the grid.
+        channels (N np.array):
+            channel of each atom.
+        rot_mat (3x3 np.array):
+            rotation matrix to apply to atoms before putting in grid.
+        dtype (np.dtype):
+            type of the grid.
+    Returns:
+        4-d numpy array representing an occupancy grid where last dimension
+        is atom channel.  First 3 dimension are of size radius_ang * 2 + 1.
+    """
+    size = grid_size(config)
+    true_radius = size * config.resolution / 2.0
+
     # Apply rotation matrix.
     at = np.dot(at, rot_mat)
     at = (np.around((at + true_radius) / config.resolution - 0.5)).astype(np.int16)
 
-    # Prune out atoms outside of grid as well as non-existent atoms.
-    sel = np.all(at >= 0, axis=1) & np.all(at < size, axis=1) & (elements != '')
-    at = at[sel]
+    # Prune out atoms outside of grid.
+    sel = np.all(at >= 0, axis=1) & np.all(at < size, axis=1)
 
     # Form final grid.
-    labels = elements[sel]
-    lsel = np.nonzero([_recognized(x, config.element_mapping) for x in labels])
-    labels = labels[lsel]
-    labels = np.array([config.element_mapping[x] for x in labels], dtype=np.int8)
-
-    grid = np.zeros(grid_shape(config), dtype=np.float32)
-    grid[at[lsel, 0], at[lsel, 1], at[lsel, 2], labels] = 1
+    grid = np.zeros(grid_shape(config), dtype=dtype)
+    grid[at[sel, 0], at[sel, 1], at[sel, 2], channels[sel]] = 1
 
     return grid
 
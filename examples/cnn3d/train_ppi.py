@@ -1,18 +1,22 @@
 from __future__ import division, print_function, absolute_import
 
 import argparse
+import contextlib
 import functools
 import json
 import logging
 import math
 import os
 import random
+import tempfile
 
 import numpy as np
 import pandas as pd
 import sklearn.metrics as sm
 import tensorflow as tf
 import tqdm
+from tensorflow.contrib.compiler import jit
+from tensorflow.core.protobuf import rewriter_config_pb2
 
 try:
     tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
@@ -31,13 +35,14 @@ de.load_dotenv(de.find_dotenv(usecwd=True))
 
 def compute_perf(results):
     res = {}
-    all_trues = results['true'].astype(np.int8)
-    all_preds = results['pred'].astype(np.int8)
+    all_trues = results['true'].to_numpy(np.int8, copy=False)
+    all_preds = results['pred'].to_numpy(np.float32, copy=False)
+    all_preds_round = (all_preds >= 0.5).astype(np.int8)
     res['all_ap'] = sm.average_precision_score(all_trues, all_preds)
     res['all_auroc'] = sm.roc_auc_score(all_trues, all_preds)
-    res['all_acc'] = sm.accuracy_score(all_trues, all_preds.round())
+    res['all_acc'] = sm.accuracy_score(all_trues, all_preds_round)
     res['all_bal_acc'] = \
-        sm.balanced_accuracy_score(all_trues, all_preds.round())
+        sm.balanced_accuracy_score(all_trues, all_preds_round)
     res['all_loss'] = sm.log_loss(all_trues, all_preds)
     return res
 
@@ -61,16 +66,23 @@ def __stats(mode, df):
         float(res["all_loss"])))
 
 
+def __results_df(structures, labels, preds, logits):
+    # Build column-wise to keep the numeric columns typed.
+    df = pd.DataFrame({
+        'structure': structures,
+        'true': labels.astype(np.int8, copy=False),
+        'pred': preds.astype(np.int8, copy=False),
+        'logits': logits.astype(np.float32, copy=False),
+        })
+    df[['ensemble', 'res0', 'res1']] = df.structure.str.split('/', expand=True)
+    return df
+
+
 def compute_accuracy(true_y, predicted_y):
-    true_y = tf.cast(true_y, tf.float32)
-    correct_prediction =  \
-        tf.logical_or(
-            tf.logical_and(
-                tf.less_equal(predicted_y, 0.5),
-                tf.less_equal(true_y, 0.5)),
-            tf.logical_and(
-                tf.greater(predicted_y, 0.5),
-                tf.greater(true_y, 0.5)))
+    # Both are float32 already, a prediction is correct if it falls on the same
+    # side of 0.5 as the label.
+    correct_prediction = tf.equal(
+        tf.greater(predicted_y, 0.5), tf.greater(true_y, 0.5))
     return tf.cast(correct_prediction, tf.float32, name='accuracy')
 
 
@@ -101,64 +113,160 @@ def conv_model(feature, target, is_training, conv_drop_rate, fc_drop_rate,
         dropout=not args.no_dropout,
         top_nn_activation=args.top_nn_activation)
 
-    # Prediction
-    predict = tf.round(tf.nn.sigmoid(logits), name='predict')
-
-    # Loss
-    with tf.variable_scope('loss'):
-        loss = tf.nn.weighted_cross_entropy_with_logits(
-            targets=tf.cast(target, tf.float32), logits=logits,
-            pos_weight=args.grid_config.neg_to_pos_ratio)
-        # We reweight the losses so that the mean is comparable across
-        # different neg to pos ratios.
-        batch_size = tf.cast(tf.shape(target)[0], tf.float32)
-        num_pos = tf.count_nonzero(target, dtype=tf.float32)
-        num_neg = batch_size - num_pos
-        effective_weight = num_pos * args.grid_config.neg_to_pos_ratio + num_neg
-        loss = loss / tf.cast(effective_weight, tf.float32) * batch_size
-        loss = tf.identity(loss, name='cross_entropy')
-
-    # Accuracy
-    accuracy = compute_accuracy(target, predict)
+    # The prediction, loss and accuracy tail is made of small element-wise
+    # ops.  With --xla_tail, have XLA compile it into fused kernels even
+    # without session-level JIT (--xla, which already covers it).  Otherwise
+    # leave the ops unmarked, so that auto-clustering can still pick them up
+    # when it is turned on through TF_XLA_FLAGS=--tf_xla_auto_jit (it is off
+    # by default).
+    if args.xla_tail:
+        jit_scope = jit.experimental_jit_scope()
+    else:
+        jit_scope = contextlib.nullcontext()
+    with jit_scope:
+        # Prediction
+        predict = tf.round(tf.nn.sigmoid(logits), name='predict')
+
+        # Loss
+        with tf.variable_scope('loss'):
+            loss = tf.nn.weighted_cross_entropy_with_logits(
+                targets=tf.cast(target, tf.float32), logits=logits,
+                pos_weight=args.grid_config.neg_to_pos_ratio)
+            # We reweight the losses so that the mean is comparable across
+            # different neg to pos ratios.
+            batch_size = tf.cast(tf.shape(target)[0], tf.float32)
+            num_pos = tf.count_nonzero(target, dtype=tf.float32)
+            num_neg = batch_size - num_pos
+            effective_weight = num_pos * args.grid_config.neg_to_pos_ratio + num_neg
+            loss = loss / tf.cast(effective_weight, tf.float32) * batch_size
+            loss = tf.identity(loss, name='cross_entropy')
+
+        # Accuracy
+        accuracy = compute_accuracy(target, predict)
     return logits, predict, loss, accuracy
 
 
-def batch_dataset_generator(gen, args, is_testing=False):
+def __dataset_structure(args, batch_dims=()):
     grid_size = subgrid_gen.grid_size(args.grid_config)
     channel_size = subgrid_gen.num_channels(args.grid_config)
-    dataset = tf.data.Dataset.from_generator(
-        gen,
-        output_types=(tf.string, tf.float32, tf.float32),
-        output_shapes=((), (2, grid_size, grid_size, grid_size, channel_size), (1,))
-        )
+    # Occupancy grids are exactly representable in float16, which halves the
+    # cost of moving them through the pipeline and to the device.
+    output_types = (tf.string, tf.float16, tf.float32)
+    output_shapes = (
+        batch_dims,
+        batch_dims + (2, grid_size, grid_size, grid_size, channel_size),
+        batch_dims + (1,))
+    return output_types, output_shapes
+
+
+def __atoms_structure():
+    # See feature_ppi.atoms_generator.
+    output_types = (tf.string, tf.float32, tf.int8, tf.float32, tf.int8,
+                    tf.float32)
+    output_shapes = ((), (None, 3), (None,), (None, 3), (None,), (1,))
+    return output_types, output_shapes
+
+
+def batch_dataset_generator(gen, args, shard_nums=None, cache_path=None,
+                            is_testing=False):
+    atoms_types, atoms_shapes = __atoms_structure()
+    output_types, output_shapes = __dataset_structure(args)
+
+    if shard_nums is None:
+        dataset = tf.data.Dataset.from_generator(
+            gen,
+            output_types=atoms_types,
+            output_shapes=atoms_shapes
+            )
+    else:
+        # Generate from several shards concurrently, so that reading shards
+        # is not bound to a single thread.  Sloppy interleaving hands out
+        # examples from whichever shard is ready, so that a slow shard does
+        # not stall the others.  Each shard in the cycle gets its own reader
+        # thread, so the cycle is bounded by the input thread budget.
+        def __shard_dataset(shard_num):
+            return tf.data.Dataset.from_generator(
+                lambda shard_num: gen(use_shard_nums=[shard_num]),
+                output_types=atoms_types,
+                output_shapes=atoms_shapes,
+                args=(shard_num,)
+                )
+
+        dataset = tf.data.Dataset.from_tensor_slices(
+            np.asarray(shard_nums, dtype=np.int64))
+        dataset = dataset.apply(tf.data.experimental.parallel_interleave(
+            __shard_dataset,
+            cycle_length=max(1, min(args.input_threads, len(shard_nums))),
+            sloppy=True))
+
+    if cache_path is not None:
+        # Replay the examples of the first pass from disk afterwards, instead
+        # of reading and sampling the shards again.  Subgrids are still
+        # rendered, and so randomly rotated, on every pass.
+        dataset = dataset.cache(cache_path)
 
     # Shuffle dataset
     if not is_testing:
         if args.shuffle:
-            dataset = dataset.repeat(count=None)
-        else:
             dataset = dataset.apply(
-                tf.contrib.data.shuffle_and_repeat(buffer_size=1000))
-
-    dataset = dataset.batch(args.batch_size)
-    dataset = dataset.prefetch(8)
-
-    iterator = dataset.make_one_shot_iterator()
-    next_element = iterator.get_next()
-    return dataset, next_element
-
-
-def train_model(sess, args):
+                tf.data.experimental.shuffle_and_repeat(buffer_size=1000))
+        else:
+            dataset = dataset.repeat(count=None)
+    else:
+        # The batch size is static, so pad the test set with empty examples to
+        # fill its last batch.  They have no structure name and are left out
+        # of the results.
+        padding = tf.data.Dataset.from_tensors((
+            tf.constant(b''),
+            tf.zeros((0, 3), tf.float32), tf.zeros((0,), tf.int8),
+            tf.zeros((0, 3), tf.float32), tf.zeros((0,), tf.int8),
+            tf.zeros((1,), tf.float32)))
+        dataset = dataset.concatenate(padding.repeat(args.batch_size - 1))
+
+    # Render the subgrids from the atoms in parallel, directly into batches.
+    def __render_feature(coords0, channels0, coords1, channels1):
+        return feature_ppi.atoms_to_feature(
+            coords0.numpy(), channels0.numpy(),
+            coords1.numpy(), channels1.numpy(),
+            args.grid_config, dtype=np.float16)
+
+    def __render(structure, coords0, channels0, coords1, channels1, label):
+        feature = tf.py_function(
+            __render_feature, [coords0, channels0, coords1, channels1],
+            output_types[1])
+        feature.set_shape(output_shapes[1])
+        return structure, feature, label
+
+    dataset = dataset.apply(tf.data.experimental.map_and_batch(
+        __render, args.batch_size,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        drop_remainder=True))
+    # Let tf.data size the prefetch buffer from the observed step time.  If the
+    # model still waits on IteratorGetNext (see the TF profiler input pipeline
+    # analysis), the input pipeline is the bottleneck.
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    # Run the pipeline on its own share of the cores, so that it is not
+    # limited by the small inter-op pool and does not compete with the
+    # intra-op pool running the model.
+    options = tf.data.Options()
+    options.experimental_threading.private_threadpool_size = args.input_threads
+    dataset = dataset.with_options(options)
+    return dataset
+
+
+def train_model(sess, args, cache_dir=None):
     # tf Graph input
-    # Subgrid maps for each residue in a protein
-    logging.debug('Create input placeholder...')
-    grid_size = subgrid_gen.grid_size(args.grid_config)
-    channel_size = subgrid_gen.num_channels(args.grid_config)
-    feature_placeholder = tf.placeholder(
-        tf.float32,
-        [None, 2, grid_size, grid_size, grid_size, channel_size],
-        name='main_input')
-    label_placeholder = tf.placeholder(tf.float32, [None, 1], 'label')
+    # Subgrid maps for each residue in a protein, consumed directly from the
+    # input pipeline.  Each mode re-initializes the iterator with its dataset.
+    # The batch size is fixed so that shapes are fully known to the graph.
+    logging.debug('Create input iterator...')
+    output_types, output_shapes = __dataset_structure(
+        args, batch_dims=(args.batch_size,))
+    iterator = tf.data.Iterator.from_structure(output_types, output_shapes)
+    structure_input, feature_input, label_input = iterator.get_next()
+    feature_input = tf.cast(feature_input, tf.float32, name='main_input')
+    label_input = tf.identity(label_input, name='label')
 
     # Placeholder for model parameters
     training_placeholder = tf.placeholder(tf.bool, shape=[], name='is_training')
@@ -169,11 +277,14 @@ def train_model(sess, args):
     # Define loss and optimizer
     logging.debug('Define loss and optimizer...')
     logits_op, predict_op, loss_op, accuracy_op = conv_model(
-        feature_placeholder, label_placeholder, training_placeholder,
+        feature_input, label_input, training_placeholder,
         conv_drop_rate_placeholder, fc_drop_rate_placeholder,
         top_nn_drop_rate_placeholder, args)
     logging.debug('Generate training ops...')
-    train_op = model.training(loss_op, args.learning_rate)
+    train_op = model.training(loss_op, args.learning_rate,
+                              mixed_precision=args.amp)
+    # Evaluation modes step through the data without updating the weights.
+    eval_op = tf.no_op(name='eval_op')
 
     # Initialize the variables (i.e. assign their default value)
     logging.debug('Initializing global variables...')
@@ -181,63 +292,106 @@ def train_model(sess, args):
 
     # Create saver and summaries.
     logging.debug('Initializing saver...')
-    saver = tf.train.Saver(max_to_keep=100000)
+    saver = tf.train.Saver(max_to_keep=args.max_to_keep,
+                           keep_checkpoint_every_n_hours=1.0)
+    # Separate saver for the best checkpoint, so that it never gets rotated out
+    # by the bounded one above.
+    best_saver = tf.train.Saver(max_to_keep=1)
     logging.debug('Finished initializing saver...')
 
-    def __loop(generator, mode, num_iters):
-        tf_dataset, next_element = batch_dataset_generator(
-            generator, args, is_testing=(mode=='test'))
+    def __shard_nums(sharded, max_num_ensembles, use_shard_nums=None):
+        # The max number of ensembles is counted across shards, so in that
+        # case the shards have to be read serially by a single generator.
+        if max_num_ensembles is not None:
+            return None
+        shard_nums = feature_ppi.get_shard_nums(sharded, use_shard_nums)
+        if args.shuffle:
+            shard_nums = np.random.permutation(shard_nums)
+        return shard_nums
+
+    def __loop(generator, shard_nums, mode, num_iters):
+        if cache_dir is not None and mode != 'test':
+            cache_path = os.path.join(cache_dir, mode)
+        else:
+            cache_path = None
+        tf_dataset = batch_dataset_generator(
+            generator, args, shard_nums=shard_nums, cache_path=cache_path,
+            is_testing=(mode=='test'))
+        sess.run(iterator.make_initializer(tf_dataset))
+        step_op = train_op if mode == 'train' else eval_op
 
-        structures, losses, logits, preds, labels = [], [], [], [], []
-        epoch_loss = 0
-        epoch_acc = 0
         progress_format = mode + ' loss: {:6.6f}' + '; acc: {:6.4f}'
 
         # Loop over all batches (one batch is all feature for 1 protein)
         num_batches = int(math.ceil(float(num_iters)/args.batch_size))
+
+        # Preallocate the results, filled batch by batch and truncated to the
+        # number of examples actually seen at the end.
+        max_num_examples = num_batches * args.batch_size
+        structures = np.empty(max_num_examples, dtype=object)
+        losses = np.empty(max_num_examples, dtype=np.float32)
+        logits = np.empty(max_num_examples, dtype=np.float32)
+        preds = np.empty(max_num_examples, dtype=np.int8)
+        labels = np.empty(max_num_examples, dtype=np.int8)
+        num_examples = 0
+        batch_losses = np.empty(num_batches, dtype=np.float32)
+        batch_accs = np.empty(num_batches, dtype=np.float32)
+        num_batches_run = 0
         #print('Running {:} -> {:} iters in {:} batches (batch size: {:})'.format(
         #    mode, num_iters, num_batches, args.batch_size))
         with tqdm.tqdm(total=num_batches, desc=progress_format.format(0, 0)) as t:
             for i in range(num_batches):
                 try:
-                    structure_, feature_, label_ = sess.run(next_element)
-                    _, logit, pred, loss, accuracy = sess.run(
-                        [train_op, logits_op, predict_op, loss_op, accuracy_op],
-                        feed_dict={feature_placeholder: feature_,
-                                   label_placeholder: label_,
-                                   training_placeholder: (mode == 'train'),
+                    _, structure_, label_, logit, pred, loss, accuracy = sess.run(
+                        [step_op, structure_input, label_input,
+                         logits_op, predict_op, loss_op, accuracy_op],
+                        feed_dict={training_placeholder: (mode == 'train'),
                                    conv_drop_rate_placeholder:
                                        args.conv_drop_rate if mode == 'train' else 0.0,
                                    fc_drop_rate_placeholder:
                                        args.fc_drop_rate if mode == 'train' else 0.0,
                                    top_nn_drop_rate_placeholder:
                                        args.top_nn_drop_rate if mode == 'train' else 0.0})
-                    epoch_loss += (np.mean(loss) - epoch_loss) / (i + 1)
-                    epoch_acc += (np.mean(accuracy) - epoch_acc) / (i + 1)
-                    structures.extend(structure_.astype(str))
-                    losses.append(loss)
-                    logits.extend(logit.astype(np.float))
-                    preds.extend(pred.astype(np.int8))
-                    labels.extend(label_.astype(np.int8))
-
-                    t.set_description(progress_format.format(epoch_loss, epoch_acc))
+                    # Leave out the padding of the last test batch.
+                    keep = (structure_ != b'')
+                    batch_losses[i] = np.mean(loss[keep])
+                    batch_accs[i] = np.mean(accuracy[keep])
+                    num_batches_run = i + 1
+                    batch = slice(num_examples, num_examples + np.count_nonzero(keep))
+                    structures[batch] = structure_[keep]
+                    losses[batch] = loss[keep, 0]
+                    logits[batch] = logit[keep, 0]
+                    preds[batch] = pred[keep, 0]
+                    labels[batch] = label_[keep, 0]
+                    num_examples = batch.stop
+
+                    # Only refresh the running averages every few steps, and on
+                    # the last one so the final values are shown.
+                    if i % 16 == 0 or i == num_batches - 1:
+                        t.set_description(progress_format.format(
+                            batch_losses[:num_batches_run].mean(),
+                            batch_accs[:num_batches_run].mean()))
                     t.update(1)
                 except (tf.errors.OutOfRangeError, StopIteration):
                     logging.info("\nEnd of {:} dataset at iteration {:}".format(mode, i))
                     break
 
-        def __concatenate(array):
-            try:
-                array = np.concatenate(array)
-                return array
-            except:
-                return array
-
-        structures = __concatenate(structures)
-        logits = __concatenate(logits)
-        preds = __concatenate(preds)
-        labels = __concatenate(labels)
-        losses = __concatenate(losses)
+            if 0 < num_batches_run < num_batches:
+                # Ran out of data early, show the averages over what was run.
+                t.set_description(progress_format.format(
+                    batch_losses[:num_batches_run].mean(),
+                    batch_accs[:num_batches_run].mean()))
+
+        # Decode the structure names (bytes) all at once.
+        structures = structures[:num_examples].astype(str)
+        logits = logits[:num_examples]
+        preds = preds[:num_examples]
+        labels = labels[:num_examples]
+        losses = losses[:num_examples]
+        if num_batches_run > 0:
+            epoch_loss = float(batch_losses[:num_batches_run].mean())
+        else:
+            epoch_loss = 0
         return structures, logits, preds, labels, losses, epoch_loss
 
     # Run the initializer
@@ -282,6 +436,12 @@ def train_model(sess, args):
                               global_step=epoch)
             return ckpt
 
+        def _save_best():
+            ckpt = best_saver.save(
+                sess, os.path.join(args.output_dir, 'model-best-ckpt'),
+                global_step=epoch, latest_filename='best_checkpoint')
+            return ckpt
+
         run_info_filename = os.path.join(args.output_dir, 'run_info.json')
         run_info = {}
         def __update_and_write_run_info(key, val):
@@ -291,38 +451,40 @@ def train_model(sess, args):
 
         per_epoch_val_losses = []
         for epoch in range(1, args.num_epochs+1):
-            random_seed = args.random_seed #random.randint(1, 10e6)
-
             logging.info('Epoch {:} - random_seed: {:}'.format(epoch, args.random_seed))
 
             logging.debug('Creating train generator...')
             train_generator_callable = functools.partial(
-                feature_ppi.dataset_generator,
+                feature_ppi.atoms_generator,
                 args.train_sharded,
                 args.grid_config,
                 shuffle=args.shuffle,
                 repeat=args.repeat_gen,
                 max_num_ensembles=args.max_num_ensembles_train,
-                testing=False,
-                random_seed=random_seed)
+                testing=False)
 
             logging.debug('Creating val generator...')
             val_generator_callable = functools.partial(
-                feature_ppi.dataset_generator,
+                feature_ppi.atoms_generator,
                 args.val_sharded,
                 args.grid_config,
                 shuffle=args.shuffle,
                 repeat=args.repeat_gen,
                 max_num_ensembles=args.max_num_ensembles_val,
-                testing=False,
-                random_seed=random_seed)
+                testing=False)
 
             # Training
+            train_shard_nums = __shard_nums(
+                args.train_sharded, args.max_num_ensembles_train)
             train_structures, train_logits, train_preds, train_labels, _, curr_train_loss = __loop(
-                train_generator_callable, 'train', num_iters=train_num_structures)
+                train_generator_callable, train_shard_nums, 'train',
+                num_iters=train_num_structures)
             # Validation
+            val_shard_nums = __shard_nums(
+                args.val_sharded, args.max_num_ensembles_val)
             val_structures, val_logits, val_preds, val_labels, _, curr_val_loss = __loop(
-                val_generator_callable, 'val', num_iters=val_num_structures)
+                val_generator_callable, val_shard_nums, 'val',
+                num_iters=val_num_structures)
 
             per_epoch_val_losses.append(curr_val_loss)
             __update_and_write_run_info('val_losses', per_epoch_val_losses)
@@ -331,7 +493,7 @@ def train_model(sess, args):
                 if curr_val_loss < best_val_loss:
                     # Found new best epoch.
                     best_val_loss = curr_val_loss
-                    ckpt = _save()
+                    ckpt = _save_best()
                     __update_and_write_run_info('val_best_loss', best_val_loss)
                     __update_and_write_run_info('best_ckpt', ckpt)
                     logging.info("New best {:}".format(ckpt))
@@ -349,18 +511,12 @@ def train_model(sess, args):
 
             ## Save train and val results
             logging.info("Saving train and val results")
-            train_df = pd.DataFrame(
-                np.array([train_structures, train_labels, train_preds, train_logits]).T,
-                columns=['structure', 'true', 'pred', 'logits'],
-                )
-            train_df[['ensemble', 'res0', 'res1']] = train_df.structure.str.split('/', expand=True)
+            train_df = __results_df(
+                train_structures, train_labels, train_preds, train_logits)
             train_df.to_pickle(os.path.join(args.output_dir, 'train_result-{:}.pkl'.format(epoch)))
 
-            val_df = pd.DataFrame(
-                np.array([val_structures, val_labels, val_preds, val_logits]).T,
-                columns=['structure', 'true', 'pred', 'logits'],
-                )
-            val_df[['ensemble', 'res0', 'res1']] = val_df.structure.str.split('/', expand=True)
+            val_df = __results_df(
+                val_structures, val_labels, val_preds, val_logits)
             val_df.to_pickle(os.path.join(args.output_dir, 'val_result-{:}.pkl'.format(epoch)))
 
             __stats('Train Epoch {:}'.format(epoch), train_df)
@@ -388,15 +544,14 @@ def train_model(sess, args):
     saver.restore(sess, to_use)
 
     test_generator_callable = functools.partial(
-        feature_ppi.dataset_generator,
+        feature_ppi.atoms_generator,
         args.test_sharded,
         args.grid_config,
         shuffle=args.shuffle,
         repeat=1,
         max_num_ensembles=args.max_num_ensembles_test,
         testing=True,
-        use_shard_nums=args.use_shard_nums,
-        random_seed=args.random_seed)
+        use_shard_nums=args.use_shard_nums)
 
     if ((not args.grid_config.full_test) and
         (args.grid_config.max_pos_regions_per_ensemble_testing > 0) and
@@ -415,15 +570,15 @@ def train_model(sess, args):
         assert False
     logging.info("Start testing with {:} structures".format(test_num_structures))
 
+    test_shard_nums = __shard_nums(
+        args.test_sharded, args.max_num_ensembles_test, args.use_shard_nums)
     test_structures, test_logits, test_preds, test_labels, _, test_loss = __loop(
-        test_generator_callable, 'test', num_iters=test_num_structures)
+        test_generator_callable, test_shard_nums, 'test',
+        num_iters=test_num_structures)
     logging.info("Finished testing")
 
-    test_df = pd.DataFrame(
-        np.array([test_structures, test_labels, test_preds, test_logits]).T,
-        columns=['structure', 'true', 'pred', 'logits'],
-        )
-    test_df[['ensemble', 'res0', 'res1']] = test_df.structure.str.split('/', expand=True)
+    test_df = __results_df(
+        test_structures, test_labels, test_preds, test_logits)
     test_df.to_pickle(os.path.join(args.output_dir, 'test_result.pkl'))
     __stats('Test', test_df)
     print(test_df.groupby(['true', 'pred']).size())
@@ -476,6 +631,21 @@ def create_train_parser():
     parser.add_argument('--debug', action='store_true', default=False)
     parser.add_argument('--unobserved', action='store_true', default=False)
     parser.add_argument('--save_all_ckpts', action='store_true', default=False)
+    parser.add_argument('--max_to_keep', type=int, default=5)
+    parser.add_argument('--xla', action='store_true', default=False)
+    parser.add_argument('--xla_tail', action='store_true', default=False)
+    # Thread budget: the cores are split between the model ops (intra-op) and
+    # the input pipeline.  By default each gets half of them.
+    parser.add_argument('--intra_op_threads', type=int, default=None)
+    parser.add_argument('--inter_op_threads', type=int, default=2)
+    parser.add_argument('--input_threads', type=int, default=None)
+    # Mixed precision only speeds up training on GPUs with tensor cores
+    # (Volta or newer).
+    parser.add_argument('--amp', action='store_true', default=False)
+    # Cache the train and val examples under this directory (ideally on a
+    # local SSD) during the first epoch.  Later epochs then reuse the same
+    # sampled residue pairs.
+    parser.add_argument('--cache_dir', type=str, default=None)
 
     # Test only
     parser.add_argument('--test_only', action='store_true', default=False)
@@ -490,6 +660,15 @@ def main():
     parser = create_train_parser()
     args = parser.parse_args()
 
+    num_cpus = os.cpu_count() or 1
+    if args.input_threads is None:
+        if args.intra_op_threads is None:
+            args.input_threads = max(1, num_cpus // 2)
+        else:
+            args.input_threads = max(1, num_cpus - args.intra_op_threads)
+    if args.intra_op_threads is None:
+        args.intra_op_threads = max(1, num_cpus - args.input_threads)
+
     args.__dict__['grid_config'] = feature_ppi.grid_config
 
     if args.test_only:
@@ -539,11 +718,35 @@ def main():
     args.val_sharded = sh.Sharded.load(args.val_sharded)
     args.test_sharded = sh.Sharded.load(args.test_sharded)
 
+    config = tf.ConfigProto(
+        intra_op_parallelism_threads=args.intra_op_threads,
+        inter_op_parallelism_threads=args.inter_op_threads)
+    if args.amp:
+        # Rewrite the graph to run convs and matmuls in float16, keeping
+        # numerically sensitive ops (e.g. the loss) in float32.  This must be
+        # set before the session is created.
+        config.graph_options.rewrite_options.auto_mixed_precision = \
+            rewriter_config_pb2.RewriterConfig.ON
+    if args.xla:
+        # Fuse the many small point-wise ops of the model into XLA clusters.
+        # Global JIT only covers GPU by default, also enable it for CPU.
+        os.environ.setdefault('TF_XLA_FLAGS', '--tf_xla_cpu_global_jit')
+        config.graph_options.optimizer_options.global_jit_level = \
+            tf.OptimizerOptions.ON_1
+
+    # Per-run cache directory, removed at the end of the run even if it fails.
+    if args.cache_dir is not None:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        cache_context = tempfile.TemporaryDirectory(
+            prefix='ppi-', dir=args.cache_dir)
+    else:
+        cache_context = contextlib.nullcontext()
+
     logging.info("Writing all output to {:}".format(args.output_dir))
-    with tf.Session() as sess:
+    with cache_context as cache_dir, tf.Session(config=config) as sess:
         np.random.seed(args.random_seed)
         tf.set_random_seed(args.random_seed)
-        train_model(sess, args)
+        train_model(sess, args, cache_dir=cache_dir)
 
 
 if __name__ == '__main__':